@@ -1,7 +1,274 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
 import spotipy
 import spotipy.util as util
 import numpy as np
-import scipy.stats
+import scipy.linalg
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# The audio features used to build a track's feature vector, in vector order
+FEATURE_KEYS = ('acousticness', 'danceability', 'energy', 'instrumentalness',
+                'key', 'liveness', 'loudness', 'mode', 'speechiness', 'tempo',
+                'time_signature', 'valence')
+NUM_FEATURES = len(FEATURE_KEYS)
+# The continuous features, which are modelled with a multivariate normal
+CONT_KEYS = ('acousticness', 'danceability', 'energy', 'instrumentalness',
+             'liveness', 'loudness', 'speechiness', 'tempo', 'valence')
+# The categorical features and the values they can take, which are each
+# modelled with their own categorical distribution. A key of -1 means no key
+# was detected
+CATEGORIES = collections.OrderedDict([
+    ('key', tuple(range(-1, 12))),
+    ('mode', (0, 1)),
+    ('time_signature', (3, 4, 5, 6, 7)),
+])
+CAT_KEYS = tuple(CATEGORIES)
+CONT_INDEX = [FEATURE_KEYS.index(key) for key in CONT_KEYS]
+CAT_INDEX = [FEATURE_KEYS.index(key) for key in CAT_KEYS]
+# The documented range of each continuous feature. Features are standardized
+# as though they were uniform over these ranges so that no feature dominates
+# the covariance because of its units
+FEATURE_RANGES = {
+    'acousticness': (0.0, 1.0),
+    'danceability': (0.0, 1.0),
+    'energy': (0.0, 1.0),
+    'instrumentalness': (0.0, 1.0),
+    'liveness': (0.0, 1.0),
+    'loudness': (-60.0, 0.0),
+    'speechiness': (0.0, 1.0),
+    'tempo': (0.0, 250.0),
+    'valence': (0.0, 1.0),
+}
+FEATURE_LOC = np.array([sum(FEATURE_RANGES[key]) / 2 for key in CONT_KEYS],
+                       dtype=np.float32)
+FEATURE_SCALE = np.array([(FEATURE_RANGES[key][1] - FEATURE_RANGES[key][0]) /
+                          np.sqrt(12) for key in CONT_KEYS], dtype=np.float32)
+# The maximum number of track IDs accepted by a single audio features request
+AUDIO_FEATURES_BATCH_SIZE = 100
+# Page sizes used when walking the playlist and playlist track listings
+PLAYLISTS_PAGE_SIZE = 50
+TRACKS_PAGE_SIZE = 100
+# The only parts of a playlist items page that are used
+TRACKS_FIELDS = 'items(track(id)),total'
+# Spotify allows roughly 180 requests per minute
+REQUESTS_PER_MINUTE = 180
+MAX_CONCURRENT_REQUESTS = 10
+# How many more times a request is tried after spotify answers it with 429
+MAX_RETRIES = 3
+# The number of playlist distributions estimated at once
+MAX_WORKERS = 8
+# Where audio features and playlist distributions are cached between sessions
+CACHE_PATH = os.path.expanduser(os.path.join('~', '.otto-pl', 'cache.sqlite'))
+# Bump this whenever a change to the features, their scaling or how models are
+# estimated would make models cached on disk stale
+MODEL_VERSION = 1
+# Audio features only have a few significant digits, so models are stored in
+# single precision to halve their memory traffic
+DTYPE = np.float32
+# Added to covariance diagonals so that they can be Cholesky factored
+COV_JITTER = DTYPE(1e-6)
+# Playlists with fewer tracks than this get a diagonal covariance, since their
+# full sample covariance is rank deficient or poorly estimated
+MIN_TRACKS_FULL_COV = 2 * len(CONT_KEYS)
+# Added to the variances of diagonal covariances
+VAR_JITTER = DTYPE(1e-4)
+LOG2PI = DTYPE(np.log(2 * np.pi))
+
+# A multivariate normal distribution, stored as its mean, the lower Cholesky
+# factor of its covariance and the log determinant of its covariance
+Gaussian = collections.namedtuple('Gaussian', ['mean', 'L', 'logdet'])
+# The model for a playlist: a Gaussian over the continuous features and a dict
+# mapping each categorical feature to the log probability of each of its values
+PlaylistModel = collections.namedtuple('PlaylistModel',
+                                       ['gaussian', 'categorical'])
+
+
+class TokenBucket(object):
+    """ A thread safe token bucket rate limiter, which allows bursts of up to
+    `capacity` requests and then refills at the sustained rate
+
+    Args:
+        rate (int): The number of requests allowed every `per` seconds
+        per (float): The length of the rate limiting window in seconds
+        capacity (int): The largest burst of requests allowed at once
+    """
+
+    def __init__(self, rate, per=60.0, capacity=1):
+        self.interval = per / rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token for a request
+
+        Returns:
+            float: The number of seconds to wait before making the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens +
+                               (now - self._updated) / self.interval)
+            self._updated = now
+            # A negative balance is paid off by waiting for it to refill
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens * self.interval)
+            return max(wait, self._blocked_until - now)
+
+    def block(self, delay):
+        """ Hold back every request for a while, such as after spotify asks
+        for requests to be retried later
+
+        Args:
+            delay (float): The number of seconds to hold requests back for
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until,
+                                      time.monotonic() + delay)
+            # Don't let a burst build up while blocked
+            self._tokens = min(self._tokens, 0.0)
+
+
+_rate_limiter = TokenBucket(REQUESTS_PER_MINUTE,
+                            capacity=MAX_CONCURRENT_REQUESTS)
+
+
+def _backoff(error, attempt):
+    """ Decide whether to retry a failed request, and if so hold back every
+    request for as long as spotify asked
+
+    Args:
+        error (spotipy.SpotifyException): The error the request failed with
+        attempt (int): How many times the request has been retried already
+
+    Returns:
+        bool: Whether the request should be retried
+    """
+    # spotipy has already spent its own Retry-After retries by the time the
+    # error reaches here, and the error it raises then carries no headers, so
+    # the number of further attempts has to be bounded
+    if error.http_status != 429 or attempt >= MAX_RETRIES:
+        return False
+    headers = getattr(error, 'headers', None) or {}
+    _rate_limiter.block(float(headers.get('Retry-After', 1)))
+    return True
+
+
+async def _request(semaphore, fetch, *args):
+    """ Run a blocking spotipy call in the default executor, respecting the
+    rate limit and retrying 429 responses up to MAX_RETRIES times
+
+    Args:
+        semaphore (asyncio.Semaphore): Bounds the number of requests in flight
+        fetch (callable): The blocking spotipy call to make
+        *args: Arguments passed to fetch
+
+    Returns:
+        dict: The response from fetch
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(MAX_RETRIES + 1):
+        async with semaphore:
+            await asyncio.sleep(_rate_limiter.reserve())
+            try:
+                return await loop.run_in_executor(
+                    None, functools.partial(fetch, *args))
+            except spotipy.SpotifyException as e:
+                if not _backoff(e, attempt):
+                    raise
+
+
+def _request_sync(fetch, *args):
+    """ Make a blocking spotipy call on the current thread, respecting the
+    rate limit and retrying 429 responses up to MAX_RETRIES times
+
+    Args:
+        fetch (callable): The blocking spotipy call to make
+        *args: Arguments passed to fetch
+
+    Returns:
+        dict: The response from fetch
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        time.sleep(_rate_limiter.reserve())
+        try:
+            return fetch(*args)
+        except spotipy.SpotifyException as e:
+            if not _backoff(e, attempt):
+                raise
+
+
+async def _gather_pages(fetch, page_size):
+    """ Fetch every page of a paginated listing concurrently
+
+    Args:
+        fetch (callable): Takes an offset and returns the page at that offset
+        page_size (int): The number of items per page
+
+    Returns:
+        list: The items from every page, in order
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    first = await _request(semaphore, fetch, 0)
+    offsets = range(page_size, first['total'], page_size)
+    pages = await asyncio.gather(
+        *[_request(semaphore, fetch, offset) for offset in offsets])
+    items = list(first['items'])
+    for page in pages:
+        items.extend(page['items'])
+    return items
+
+
+def get_all_items(fetch, page_size):
+    """ Get every item from a paginated spotify listing
+
+    Args:
+        fetch (callable): Takes an offset and returns the page at that offset
+        page_size (int): The number of items per page
+
+    Returns:
+        list: The items from every page, in order
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_gather_pages(fetch, page_size))
+    # Already inside an event loop, as in Jupyter, so run ours on its own
+    # thread rather than nesting it
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(
+            lambda: asyncio.run(_gather_pages(fetch, page_size))).result()
+
+
+@functools.lru_cache(maxsize=1)
+def _current_user_id(sp):
+    """ Get the spotify ID of the user a client is authorized as, which is
+    fixed for the lifetime of the client
+
+    Args:
+        sp (spotipy.client.Spotify): A spotipy client with an auth token
+
+    Returns:
+        str: The user's spotify ID
+    """
+    return sp.current_user()['id']
 
 
 def get_playlists(sp):
@@ -13,19 +280,17 @@ def get_playlists(sp):
     Returns:
         list: A list containing spotify playlist objects represented as dicts
     """
-    user = sp.current_user()
-    playlists = []
-    s_playlists = sp.user_playlists(user['id'])
+    uid = _current_user_id(sp)
+    s_playlists = get_all_items(
+        lambda offset: sp.current_user_playlists(limit=PLAYLISTS_PAGE_SIZE,
+                                                 offset=offset),
+        PLAYLISTS_PAGE_SIZE)
 
-    while s_playlists['next']:
-        for playlist in s_playlists['items']:
-            if ((not playlist['collaborative']) and 
-                    playlist['owner']['id'] == user['id'] and
-                    playlist['public'] and playlist['tracks']['total'] >1):
-                playlists.append(playlist)
-        s_playlists = sp.next(s_playlists)
-
-    return playlists
+    # Only keep public playlists the user owns with enough tracks to model
+    return [playlist for playlist in s_playlists
+            if not playlist['collaborative'] and
+            playlist['owner']['id'] == uid and
+            playlist['public'] and playlist['tracks']['total'] > 1]
 
 
 def get_tracks_from_playlist(sp, playlist):
@@ -36,21 +301,110 @@ def get_tracks_from_playlist(sp, playlist):
         playlist (dict): A dictionary representing a spotify playlist
 
     Returns:
-        list: A list containing spotify track objects represented as dicts
+        list: A list containing spotify track objects represented as dicts,
+            with only their IDs populated
+    """
+    s_tracks = get_all_items(
+        lambda offset: sp.playlist_items(playlist['id'], fields=TRACKS_FIELDS,
+                                         limit=TRACKS_PAGE_SIZE, offset=offset,
+                                         additional_types=('track',)),
+        TRACKS_PAGE_SIZE)
+    tracks = [item['track'] for item in s_tracks]
+
+    # Removed and local tracks have no track object or no ID
+    return [t for t in tracks if t and t.get('id') is not None]
+
+
+def _open_cache():
+    """ Open the on-disk cache, creating it if needed
+
+    Returns:
+        sqlite3.Connection: A connection to the cache database
+    """
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH)
+    conn.execute('CREATE TABLE IF NOT EXISTS audio_features '
+                 '(id TEXT PRIMARY KEY, features TEXT NOT NULL)')
+    columns = [row[1] for row in
+               conn.execute('PRAGMA table_info(distributions)')]
+    if columns and 'model_version' not in columns:
+        # Written before models were versioned, so they can't be trusted
+        conn.execute('DROP TABLE distributions')
+    conn.execute('CREATE TABLE IF NOT EXISTS distributions '
+                 '(playlist_id TEXT NOT NULL, snapshot_id TEXT NOT NULL, '
+                 'model_version INTEGER NOT NULL, model BLOB NOT NULL, '
+                 'PRIMARY KEY (playlist_id, snapshot_id, model_version))')
+    return conn
+
+
+def cached_audio_features(sp, ids):
+    """ Get the audio features for the given tracks, only asking spotify for
+    tracks that are not already in the on-disk cache
+
+    Args:
+        sp (spotipy.client.Spotify): A spotipy client with an auth token
+        ids (list(str)): The spotify IDs of the tracks
+
+    Returns:
+        list: The audio features for each track represented as dicts, or None
+            for tracks spotify has no features for
     """
-    user = sp.current_user()
-    results = sp.user_playlist(user['id'], playlist['id'], fields='tracks,next')
-    s_tracks = results['tracks']
-    tracks = []
+    with contextlib.closing(_open_cache()) as conn:
+        hits = {}
+        for i in range(0, len(ids), AUDIO_FEATURES_BATCH_SIZE):
+            chunk = ids[i:i + AUDIO_FEATURES_BATCH_SIZE]
+            rows = conn.execute(
+                'SELECT id, features FROM audio_features WHERE id IN (%s)'
+                % ','.join('?' * len(chunk)), chunk)
+            hits.update((id_, json.loads(features)) for id_, features in rows)
+
+        misses = list(dict.fromkeys(id_ for id_ in ids if id_ not in hits))
+        for i in range(0, len(misses), AUDIO_FEATURES_BATCH_SIZE):
+            chunk = misses[i:i + AUDIO_FEATURES_BATCH_SIZE]
+            batch = _request_sync(sp.audio_features, chunk)
+            for id_, features in zip(chunk, batch):
+                hits[id_] = features
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO audio_features VALUES (?, ?)',
+                    [(id_, json.dumps(hits[id_])) for id_ in chunk
+                     if hits[id_] is not None])
+
+    return [hits[id_] for id_ in ids]
 
-    while True:
-        for track in s_tracks['items']:
-            tracks.append(track['track'])
-        if not s_tracks['next']:
-            break
-        s_tracks = sp.next(s_tracks)
 
-    return filter(lambda t: t['id'] is not None, tracks)
+def standardize(data):
+    """ Put continuous feature vectors on a common scale
+
+    Args:
+        data (numpy.ndarray): Continuous feature vectors in their spotify
+            units, one per row
+
+    Returns:
+        numpy.ndarray: The standardized feature vectors
+    """
+    return (data - FEATURE_LOC) / FEATURE_SCALE
+
+
+def split_features(data):
+    """ Split raw feature vectors into their continuous and categorical parts
+
+    Args:
+        data (numpy.ndarray): Feature vectors ordered as FEATURE_KEYS, with NaN
+            for missing features, one per row
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray): The standardized continuous
+            features, with missing features set to 0 before scaling, and the
+            index of each categorical feature's value in CATEGORIES, or -1 if
+            it is missing or unrecognised
+    """
+    cont = standardize(np.nan_to_num(data[..., CONT_INDEX], nan=0.0))
+    cats = []
+    for key, col in zip(CAT_KEYS, CAT_INDEX):
+        match = data[..., col, None] == np.array(CATEGORIES[key])
+        cats.append(np.where(match.any(axis=-1), match.argmax(axis=-1), -1))
+    return cont, np.stack(cats, axis=-1)
 
 
 def feature_vector_from_track(sp, track):
@@ -61,25 +415,19 @@ def feature_vector_from_track(sp, track):
         track (dict): A dictionary representing a spotify track object
 
     Returns:
-        list: A list representing a feature vector for the given track
+        numpy.ndarray: An array representing a feature vector for the given
+            track, ordered as FEATURE_KEYS, with NaN for missing features
+
+    Raises:
+        ValueError: If spotify has no audio features for the track
     """
-    track_features = sp.audio_features([track['id']])[0]
-    # Now construct vector
-    vector = []
-    vector.append(track_features['acousticness'])
-    vector.append(track_features['danceability'])
-    vector.append(track_features['energy'])
-    vector.append(track_features['instrumentalness'])
-    vector.append(track_features['key'])
-    vector.append(track_features['liveness'])
-    vector.append(track_features['loudness'])
-    vector.append(track_features['mode'])
-    vector.append(track_features['speechiness'])
-    vector.append(track_features['tempo'])
-    vector.append(track_features['time_signature'])
-    vector.append(track_features['valence'])
+    track_features = cached_audio_features(sp, [track['id']])[0]
+    if track_features is None:
+        raise ValueError('spotify has no audio features for track %s'
+                         % track['id'])
 
-    return vector
+    return np.array([track_features.get(key) for key in FEATURE_KEYS],
+                    dtype=DTYPE)
 
 
 def use_user(username):
@@ -99,35 +447,415 @@ def use_user(username):
         print("cant get token for", username)
 
 
+def gaussian_from_moments(mean, cov):
+    """ Factor a covariance matrix into a Gaussian
+
+    Args:
+        mean (numpy.ndarray): The mean of the distribution
+        cov (numpy.ndarray): The covariance of the distribution
+
+    Returns:
+        Gaussian: The multivariate normal distribution with the given moments
+    """
+    cov = cov + COV_JITTER * np.eye(len(mean), dtype=cov.dtype)
+    try:
+        L = np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        # Not positive definite, so clamp the eigenvalues and take the
+        # triangular factor of the resulting square root instead
+        w, v = np.linalg.eigh(cov)
+        root = v * np.sqrt(np.maximum(w, COV_JITTER))
+        L = np.linalg.qr(root.T, mode='r').T
+    logdet = 2 * np.sum(np.log(np.abs(np.diag(L))))
+    return Gaussian(mean, L, logdet)
+
+
+def gaussian_from_variances(mean, var):
+    """ Build a Gaussian with a diagonal covariance, whose Cholesky factor is
+    just the standard deviations
+
+    Args:
+        mean (numpy.ndarray): The mean of the distribution
+        var (numpy.ndarray): The variance of each dimension
+
+    Returns:
+        Gaussian: The multivariate normal distribution with the given moments
+    """
+    var = var + VAR_JITTER
+    return Gaussian(mean, np.diag(np.sqrt(var)), np.sum(np.log(var)))
+
+
+def gaussian_logpdf(dist, x):
+    """ Evaluate the log density of a Gaussian at a point
+
+    Args:
+        dist (Gaussian): The distribution to evaluate
+        x (numpy.ndarray): The point to evaluate the density at
+
+    Returns:
+        float: The log density of dist at x
+    """
+    d = x - dist.mean
+    y = scipy.linalg.solve_triangular(dist.L, d, lower=True)
+    return -0.5 * (len(d) * LOG2PI + dist.logdet + y @ y)
+
+
+def categorical_log_probs(indices, num_categories):
+    """ Estimate a Laplace smoothed categorical distribution
+
+    Args:
+        indices (numpy.ndarray): The observed category indices, with -1 for
+            missing observations
+        num_categories (int): The number of categories
+
+    Returns:
+        numpy.ndarray: The log probability of each category
+    """
+    counts = np.bincount(indices[indices >= 0], minlength=num_categories)
+    return np.log((counts + 1) / (counts.sum() + num_categories)).astype(DTYPE)
+
+
+def categorical_log_likelihood(log_probs, categories):
+    """ Sum the log probabilities of a track's categorical features
+
+    Args:
+        log_probs (dict): Maps each categorical feature to the log probability
+            of each of its values, either as a single array or stacked with
+            one row per playlist
+        categories (numpy.ndarray): The index of each categorical feature's
+            value, ordered as CAT_KEYS, with -1 for missing values
+
+    Returns:
+        float or numpy.ndarray: The log likelihood of the categorical features,
+            for each playlist if log_probs is stacked
+    """
+    return sum(log_probs[key][..., index]
+               for key, index in zip(CAT_KEYS, categories) if index >= 0)
+
+
+def batch_logpdf(x, means, Ls, logdets):
+    """ Evaluate the log densities of several Gaussians at a single point
+
+    Args:
+        x (numpy.ndarray): The (d,) point to evaluate the densities at
+        means (numpy.ndarray): The (K, d) means of the distributions
+        Ls (numpy.ndarray): The (K, d, d) lower Cholesky factors of the
+            covariances of the distributions
+        logdets (numpy.ndarray): The (K,) log determinants of the covariances
+            of the distributions
+
+    Returns:
+        numpy.ndarray: The (K,) log densities of each distribution at x
+    """
+    # The compiled kernel only accepts DTYPE arrays, so convert up front to
+    # give both implementations the same inputs
+    x, means, Ls, logdets = (np.ascontiguousarray(a, dtype=DTYPE)
+                             for a in (x, means, Ls, logdets))
+    if numba is not None:
+        return _batch_logpdf_numba(x, means, Ls, logdets)
+    D = x[None, :] - means
+    Y = np.linalg.solve(Ls, D[..., None])[..., 0]
+    return -0.5 * (means.shape[1] * LOG2PI + logdets +
+                   np.einsum('ki,ki->k', Y, Y))
+
+
+if numba is not None:
+    @numba.njit('float32[:](float32[:], float32[:, :], float32[:, :, :], '
+                'float32[:])', parallel=True, fastmath=True)
+    def _batch_logpdf_numba(x, means, Ls, logdets):
+        """ Compiled equivalent of batch_logpdf, solving each triangular system
+        by forward substitution """
+        K, d = means.shape
+        out = np.empty(K, dtype=np.float32)
+        for k in numba.prange(K):
+            y = np.empty(d, dtype=np.float32)
+            quad = np.float32(0.0)
+            for i in range(d):
+                s = x[i] - means[k, i]
+                for j in range(i):
+                    s -= Ls[k, i, j] * y[j]
+                y[i] = s / Ls[k, i, i]
+                quad += y[i] * y[i]
+            out[k] = -0.5 * (d * LOG2PI + logdets[k] + quad)
+        return out
+
+
+class PlaylistModelStore(object):
+    """ The distributions for several playlists, stored as contiguous arrays of
+    means, Cholesky factors and log determinants so that they can be scored
+    together. Only the latest snapshot of each playlist is kept
+
+    Args:
+        num_features (int): The dimension of the distributions
+        capacity (int): The number of playlists to allocate space for up front
+    """
+
+    def __init__(self, num_features=len(CONT_KEYS), capacity=16):
+        self.ids = []
+        self.snapshots = []
+        self.names = []
+        self._index = {}
+        self._lock = threading.Lock()
+        self.means = np.empty((capacity, num_features), dtype=DTYPE)
+        self.Ls = np.empty((capacity, num_features, num_features), dtype=DTYPE)
+        self.logdets = np.empty(capacity, dtype=DTYPE)
+        self.cat_log_probs = {key: np.empty((capacity, len(values)),
+                                            dtype=DTYPE)
+                              for key, values in CATEGORIES.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _grow(self):
+        """ Double the capacity of the store """
+        size = len(self)
+        capacity = 2 * max(size, 1)
+
+        def grown(old):
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:size] = old[:size]
+            return new
+
+        self.means = grown(self.means)
+        self.Ls = grown(self.Ls)
+        self.logdets = grown(self.logdets)
+        self.cat_log_probs = {key: grown(old)
+                              for key, old in self.cat_log_probs.items()}
+
+    def add(self, playlist_id, snapshot_id, name, mean, L, logdet,
+            cat_log_probs):
+        """ Add the distribution for a playlist, replacing any distribution
+        already stored for any snapshot of it
+
+        Args:
+            playlist_id (str): The spotify ID of the playlist
+            snapshot_id (str): The snapshot ID of the playlist
+            name (str): The name of the playlist
+            mean (numpy.ndarray): The mean of the distribution
+            L (numpy.ndarray): The lower Cholesky factor of the covariance of
+                the distribution
+            logdet (float): The log determinant of the covariance of the
+                distribution
+            cat_log_probs (dict): Maps each categorical feature to the log
+                probability of each of its values
+        """
+        with self._lock:
+            index = self._index.get(playlist_id)
+            if index is None:
+                index = len(self)
+                if index == len(self.logdets):
+                    self._grow()
+                self._index[playlist_id] = index
+                self.ids.append(playlist_id)
+                self.snapshots.append(snapshot_id)
+                self.names.append(name)
+            else:
+                self.snapshots[index] = snapshot_id
+                self.names[index] = name
+            self.means[index] = mean
+            self.Ls[index] = L
+            self.logdets[index] = logdet
+            for feature, log_probs in cat_log_probs.items():
+                self.cat_log_probs[feature][index] = log_probs
+
+    def index(self, playlist_id, snapshot_id):
+        """ Find where a playlist's distribution is stored
+
+        Args:
+            playlist_id (str): The spotify ID of the playlist
+            snapshot_id (str): The snapshot ID of the playlist
+
+        Returns:
+            int: The row of the playlist in the store, or None if that
+                snapshot of it is not stored
+        """
+        index = self._index.get(playlist_id)
+        if index is None or self.snapshots[index] != snapshot_id:
+            return None
+        return index
+
+    def get(self, playlist_id, snapshot_id):
+        """ Get a copy of the distribution stored for a playlist
+
+        Args:
+            playlist_id (str): The spotify ID of the playlist
+            snapshot_id (str): The snapshot ID of the playlist
+
+        Returns:
+            PlaylistModel: The playlist's distributions, or None if they are
+                not stored
+        """
+        with self._lock:
+            index = self.index(playlist_id, snapshot_id)
+            if index is None:
+                return None
+            gaussian = Gaussian(self.means[index].copy(),
+                                self.Ls[index].copy(), self.logdets[index])
+            categorical = {feature: log_probs[index].copy()
+                           for feature, log_probs in self.cat_log_probs.items()}
+        return PlaylistModel(gaussian, categorical)
+
+    def score(self, x, categories, keys):
+        """ Evaluate the log likelihood of a track under the stored models of
+        the given playlists
+
+        Args:
+            x (numpy.ndarray): The track's standardized continuous features
+            categories (numpy.ndarray): The index of each of the track's
+                categorical features' values, with -1 for missing values
+            keys (list(tuple(str, str))): The spotify ID and snapshot ID of
+                each playlist to score
+
+        Returns:
+            tuple(list, numpy.ndarray): The names of the playlists that have a
+                stored model and the log likelihood of the track under each of
+                their models
+        """
+        with self._lock:
+            rows = [self.index(playlist_id, snapshot_id)
+                    for playlist_id, snapshot_id in keys]
+            rows = np.array([row for row in rows if row is not None],
+                            dtype=np.intp)
+            likelihoods = batch_logpdf(x, self.means[rows], self.Ls[rows],
+                                       self.logdets[rows])
+            cat_log_probs = {key: log_probs[rows]
+                             for key, log_probs in self.cat_log_probs.items()}
+            names = [self.names[row] for row in rows]
+        return names, likelihoods + categorical_log_likelihood(
+            cat_log_probs, categories)
+
+
+# Distributions estimated from playlists, kept together so that a track can be
+# scored against all of them at once
+_model_store = PlaylistModelStore()
+# Maps the IDs of playlists that no distribution could be estimated for to the
+# snapshot ID that was tried
+_unusable_playlists = {}
+
+
 def get_distribution(sp, playlist):
-    """ Create a mutivariate normal distribution using the tracks in the 
-    specified playlist.
+    """ Create a mutivariate normal distribution over the continuous features
+    and categorical distributions over the categorical features using the
+    tracks in the specified playlist.
 
     Args:
         sp (spotipy.client.Spotify): A spotipy client with an auth token
         playlist (dict): A dictionary representing a spotify playlist
 
     Returns:
-        scipy.stats.multivariate_normal: A multivariate normal distribution with 
-            mean and covariance estimated based on playlist
+        PlaylistModel: The distributions estimated based on playlist, or None
+            if none of its tracks have audio features
     """
     tracks = get_tracks_from_playlist(sp, playlist)
-    num_features = len(feature_vector_from_track(sp, tracks[0]))
-    data = np.zeros((len(tracks), num_features))
-    for index, track in enumerate(tracks):
-        vector = feature_vector_from_track(sp, track)
-        vector = map(lambda x: 0 if x is None else x, vector)
-        data[index, :] = np.asarray(vector)
-    mean = np.mean(data, axis=0)
-    cov = np.cov(data, rowvar=False)
-    # return data
-    return scipy.stats.multivariate_normal(mean=mean, cov=cov,
-                                           allow_singular=True)
+    feats = cached_audio_features(sp, [track['id'] for track in tracks])
+    # Tracks without audio analysis come back as None, and missing features
+    # become NaN when converted
+    raw = np.array([[f.get(key) for key in FEATURE_KEYS]
+                    for f in feats if f is not None],
+                   dtype=DTYPE).reshape(-1, NUM_FEATURES)
+    if not len(raw):
+        return None
+    data, cats = split_features(raw)
+    mean = data.mean(axis=0)
+    if len(data) < MIN_TRACKS_FULL_COV:
+        # Unbiased like np.cov, so the spread doesn't jump between branches
+        var = data.var(axis=0, ddof=1 if len(data) > 1 else 0)
+        gaussian = gaussian_from_variances(mean, var)
+    else:
+        cov = np.cov(data, rowvar=False).astype(DTYPE)
+        gaussian = gaussian_from_moments(mean, cov)
+    categorical = {key: categorical_log_probs(cats[:, i], len(CATEGORIES[key]))
+                   for i, key in enumerate(CAT_KEYS)}
+    arrays = list(gaussian) + list(categorical.values())
+    if not all(np.all(np.isfinite(a)) for a in arrays):
+        return None
+    return PlaylistModel(gaussian, categorical)
+
+
+def _dump_model(model):
+    """ Serialize a playlist model for the on-disk cache
+
+    Args:
+        model (PlaylistModel): The model to serialize
+
+    Returns:
+        bytes: The serialized model
+    """
+    buf = io.BytesIO()
+    arrays = {'cat_' + key: log_probs
+              for key, log_probs in model.categorical.items()}
+    np.savez(buf, mean=model.gaussian.mean, L=model.gaussian.L,
+             logdet=model.gaussian.logdet, **arrays)
+    return buf.getvalue()
+
+
+def _load_model(blob):
+    """ Deserialize a playlist model from the on-disk cache
+
+    Args:
+        blob (bytes): The serialized model
+
+    Returns:
+        PlaylistModel: The deserialized model
+    """
+    with np.load(io.BytesIO(blob)) as arrays:
+        gaussian = Gaussian(arrays['mean'], arrays['L'], arrays['logdet'][()])
+        categorical = {key: arrays['cat_' + key] for key in CAT_KEYS}
+    return PlaylistModel(gaussian, categorical)
+
+
+def get_cached_distribution(sp, playlist):
+    """ Like get_distribution, but only estimates the distribution for a given
+    version of a playlist once, keeping it in memory and on disk
+
+    Args:
+        sp (spotipy.client.Spotify): A spotipy client with an auth token
+        playlist (dict): A dictionary representing a spotify playlist
+
+    Returns:
+        PlaylistModel: The distributions estimated based on playlist, or None
+            if none of its tracks have audio features
+    """
+    # The snapshot ID changes whenever the playlist is edited
+    key = (playlist['id'], playlist.get('snapshot_id'))
+    model = _model_store.get(*key)
+    if model is not None:
+        return model
+    if key[0] in _unusable_playlists and _unusable_playlists[key[0]] == key[1]:
+        return None
+
+    # Without a snapshot ID there is no way to tell if a stored model is stale
+    persist = key[1] is not None
+    if persist:
+        with contextlib.closing(_open_cache()) as conn:
+            row = conn.execute('SELECT model FROM distributions '
+                               'WHERE playlist_id = ? AND snapshot_id = ? '
+                               'AND model_version = ?',
+                               key + (MODEL_VERSION,)).fetchone()
+        if row is not None:
+            model = _load_model(row[0])
+
+    if model is None:
+        model = get_distribution(sp, playlist)
+        if model is None:
+            _unusable_playlists[key[0]] = key[1]
+            return None
+        if persist:
+            with contextlib.closing(_open_cache()) as conn, conn:
+                conn.execute('DELETE FROM distributions WHERE playlist_id = ?',
+                             key[:1])
+                conn.execute('INSERT INTO distributions VALUES (?, ?, ?, ?)',
+                             key + (MODEL_VERSION, _dump_model(model)))
+
+    _unusable_playlists.pop(key[0], None)
+    _model_store.add(key[0], key[1], playlist['name'], *model.gaussian,
+                     model.categorical)
+    return model
 
 
 def log_likelihood_track_playlist(sp, track, playlist):
     """ Return the log likelihood that a given track was generated from the same
-    distribution as a multivariate normal estimated from a given playlist
+    distributions as those estimated from a given playlist
 
     Args:
         sp (spotipy.client.Spotify): A spotipy client with an auth token
@@ -136,25 +864,47 @@ def log_likelihood_track_playlist(sp, track, playlist):
 
     Returns:
         float: The log likelihood that track belongs in playlist
+
+    Raises:
+        ValueError: If none of the playlist's tracks have audio features
     """
-    # print playlist['name']
-    dist = get_distribution(sp, playlist)
-    track_vector = feature_vector_from_track(sp, track)
-    return dist.logpdf(track_vector)
+    model = get_cached_distribution(sp, playlist)
+    if model is None:
+        raise ValueError('no tracks in playlist %s have audio features'
+                         % playlist['id'])
+    x, categories = split_features(feature_vector_from_track(sp, track))
+    return (gaussian_logpdf(model.gaussian, x) +
+            categorical_log_likelihood(model.categorical, categories))
 
 
-def log_likelihoods_for_track(sp, track, playlists):
+def log_likelihoods_for_track(sp, track, playlists, top_k=None):
     """ Return a sorted list of the log likelihoods that a given track came from
-    a playlist in playlists
+    a playlist in playlists, most likely first
 
     Args:
         sp (spotipy.client.Spotify): A spotipy client with an auth token
         track (dict): A dictionary representing a spotify track object
         playlist (list(dict)): A list of dictionaries representing spotify
             playlists
+        top_k (int): If given, only return the top_k most likely playlists
+
+    Returns:
+        list(tuple(str, float)): Pairs of playlist name and log likelihood,
+            leaving out playlists with no tracks that have audio features
     """
-    results = []
-    for playlist in playlists:
-        likelihood = log_likelihood_track_playlist(sp, track, playlist)
-        results.append((playlist['name'], likelihood))
-    return sorted(results, key=lambda pair: pair[1])
+    if not playlists:
+        return []
+    # Estimating distributions is bound by requests to spotify, so do it for
+    # several playlists at once. This fills the model store
+    with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as executor:
+        list(executor.map(
+            lambda playlist: get_cached_distribution(sp, playlist), playlists))
+    x, categories = split_features(feature_vector_from_track(sp, track))
+    # Playlists without a stored model had no usable tracks and are left out
+    names, likelihoods = _model_store.score(
+        x, categories, [(playlist['id'], playlist.get('snapshot_id'))
+                        for playlist in playlists])
+    results = zip(names, likelihoods)
+    if top_k is not None:
+        return heapq.nlargest(top_k, results, key=lambda pair: pair[1])
+    return sorted(results, key=lambda pair: pair[1], reverse=True)
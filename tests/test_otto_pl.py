@@ -0,0 +1,412 @@
+import importlib.util
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+import pytest
+import spotipy
+import scipy.stats
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'otto-pl.py')
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location('otto_pl', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+_otto = _load_module()
+
+
+@pytest.fixture
+def otto(monkeypatch, tmp_path):
+    """ The module with its caches pointed at a temporary directory and no
+    rate limiting """
+    monkeypatch.setattr(_otto, 'CACHE_PATH', str(tmp_path / 'cache.sqlite'))
+    monkeypatch.setattr(_otto, '_rate_limiter', _otto.TokenBucket(1e9))
+    monkeypatch.setattr(_otto, '_model_store', _otto.PlaylistModelStore())
+    monkeypatch.setattr(_otto, '_unusable_playlists', {})
+    return _otto
+
+
+def _features(track_id):
+    rng = np.random.default_rng(zlib.crc32(track_id.encode()))
+    features = {key: rng.random() for key in _otto.CONT_KEYS}
+    features.update(id=track_id, key=int(rng.integers(12)),
+                    mode=int(rng.integers(2)), time_signature=4,
+                    loudness=-60 * rng.random(), tempo=60 + 120 * rng.random())
+    return features
+
+
+class FakeSpotify(object):
+    """ Serves paginated playlists and tracks the way spotipy does """
+
+    def __init__(self, playlist_sizes, no_features=()):
+        self.playlists = [
+            {'id': 'p%d' % i, 'name': 'playlist %d' % i,
+             'snapshot_id': 's%d' % i, 'collaborative': False, 'public': True,
+             'owner': {'id': 'me'}, 'tracks': {'total': size}}
+            for i, size in enumerate(playlist_sizes)]
+        self.items = {
+            playlist['id']: [{'track': {'id': '%s-t%d' % (playlist['id'], j)}}
+                             for j in range(size)]
+            for playlist, size in zip(self.playlists, playlist_sizes)}
+        self.no_features = set(no_features)
+
+    @staticmethod
+    def _page(items, limit, offset):
+        return {'items': items[offset:offset + limit], 'total': len(items)}
+
+    def current_user(self):
+        return {'id': 'me'}
+
+    def current_user_playlists(self, limit=50, offset=0):
+        return self._page(self.playlists, limit, offset)
+
+    def playlist_items(self, playlist_id, fields=None, limit=50, offset=0,
+                       market=None, additional_types=('track', 'episode')):
+        return self._page(self.items[playlist_id], limit, offset)
+
+    def audio_features(self, tracks=[]):
+        assert len(tracks) <= _otto.AUDIO_FEATURES_BATCH_SIZE
+        return [None if t.split('-')[0] in self.no_features else _features(t)
+                for t in tracks]
+
+
+def test_get_playlists_fetches_every_page(otto):
+    sp = FakeSpotify([2] * 120)
+    sp.playlists[7]['collaborative'] = True
+    sp.playlists[10]['owner'] = {'id': 'someone else'}
+
+    playlists = otto.get_playlists(sp)
+
+    assert [p['id'] for p in playlists] == [
+        'p%d' % i for i in range(120) if i not in (7, 10)]
+
+
+def test_get_tracks_from_playlist_fetches_every_page(otto):
+    sp = FakeSpotify([250])
+    sp.items['p0'][0]['track'] = None
+    sp.items['p0'][249]['track'] = {'id': None}
+
+    tracks = otto.get_tracks_from_playlist(sp, sp.playlists[0])
+
+    assert [t['id'] for t in tracks] == ['p0-t%d' % j for j in range(1, 249)]
+
+
+def test_gaussian_from_moments_matches_scipy(otto):
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(200, 4)) * [1, 2, 3, 4]
+    mean, cov = data.mean(axis=0), np.cov(data, rowvar=False)
+    x = rng.normal(size=4)
+
+    dist = otto.gaussian_from_moments(mean, cov)
+
+    expected = scipy.stats.multivariate_normal(mean, cov).logpdf(x)
+    assert otto.gaussian_logpdf(dist, x) == pytest.approx(expected, rel=1e-5)
+
+
+def test_gaussian_from_moments_clamps_indefinite_covariance(otto):
+    cov = np.diag([1.0, 2.0, -1.0])
+
+    dist = otto.gaussian_from_moments(np.zeros(3), cov)
+
+    np.testing.assert_allclose(dist.L @ dist.L.T,
+                               np.diag([1.0, 2.0, otto.COV_JITTER]),
+                               atol=1e-6)
+    assert np.isfinite(dist.logdet)
+
+
+def _random_gaussians(rng, K, d):
+    means = rng.normal(size=(K, d))
+    A = rng.normal(size=(K, d, d))
+    Ls = np.linalg.cholesky(A @ A.transpose(0, 2, 1) + np.eye(d))
+    logdets = 2 * np.log(np.diagonal(Ls, axis1=1, axis2=2)).sum(axis=1)
+    return means, Ls, logdets
+
+
+def test_batch_logpdf_matches_scipy(otto):
+    rng = np.random.default_rng(1)
+    means, Ls, logdets = _random_gaussians(rng, 5, 4)
+    x = rng.normal(size=4)
+
+    expected = [scipy.stats.multivariate_normal(m, L @ L.T).logpdf(x)
+                for m, L in zip(means, Ls)]
+
+    np.testing.assert_allclose(otto.batch_logpdf(x, means, Ls, logdets),
+                               expected, rtol=1e-4)
+
+
+@pytest.mark.skipif(_otto.numba is None, reason='numba is not installed')
+def test_batch_logpdf_numba_matches_numpy(otto, monkeypatch):
+    rng = np.random.default_rng(0)
+    means, Ls, logdets = _random_gaussians(rng, 50, len(otto.CONT_KEYS))
+    x = rng.normal(size=len(otto.CONT_KEYS))
+
+    compiled = otto.batch_logpdf(x, means, Ls, logdets)
+    monkeypatch.setattr(otto, 'numba', None)
+    reference = otto.batch_logpdf(x, means, Ls, logdets)
+
+    np.testing.assert_allclose(compiled, reference, rtol=1e-5)
+
+
+def test_split_features(otto):
+    raw = dict.fromkeys(otto.FEATURE_KEYS, 0.5)
+    raw.update(key=-1, mode=1, time_signature=np.nan, loudness=np.nan)
+    vector = np.array([raw[key] for key in otto.FEATURE_KEYS])
+
+    cont, cats = otto.split_features(vector)
+
+    assert cats.tolist() == [0, 1, -1]
+    # Missing continuous features are set to 0 before standardizing
+    expected = [0.0 if key == 'loudness' else 0.5 for key in otto.CONT_KEYS]
+    np.testing.assert_allclose(cont, otto.standardize(np.array(expected)),
+                               atol=1e-6)
+
+
+def test_playlists_without_audio_features_are_skipped(otto):
+    sp = FakeSpotify([30, 30, 5], no_features=['p1'])
+
+    results = otto.log_likelihoods_for_track(sp, {'id': 'p0-t0'}, sp.playlists)
+
+    assert sorted(name for name, _ in results) == ['playlist 0', 'playlist 2']
+    assert all(np.isfinite(likelihood) for _, likelihood in results)
+    with pytest.raises(ValueError):
+        otto.log_likelihood_track_playlist(sp, {'id': 'p0-t0'},
+                                           sp.playlists[1])
+
+
+def test_token_bucket_allows_bursts_then_refills(otto):
+    bucket = otto.TokenBucket(60, per=60.0, capacity=3)
+
+    waits = [bucket.reserve() for _ in range(4)]
+
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] == pytest.approx(1.0, abs=0.05)
+
+
+def test_token_bucket_block_holds_back_every_request(otto):
+    bucket = otto.TokenBucket(60, per=60.0, capacity=3)
+
+    bucket.block(5)
+
+    assert bucket.reserve() == pytest.approx(5.0, abs=0.05)
+    assert bucket.reserve() == pytest.approx(5.0, abs=0.05)
+
+
+def _rate_limited_fetch(failures, retry_after='0'):
+    """ A fetch that is answered with 429 the given number of times """
+    calls = []
+
+    def fetch(offset):
+        calls.append(offset)
+        if len(calls) <= failures:
+            raise spotipy.SpotifyException(
+                429, -1, 'rate limited', headers={'Retry-After': retry_after})
+        return {'items': [offset], 'total': 1}
+
+    return fetch, calls
+
+
+def test_429_blocks_the_limiter_for_retry_after(otto, monkeypatch):
+    blocks = []
+    monkeypatch.setattr(otto._rate_limiter, 'block', blocks.append)
+    fetch, calls = _rate_limited_fetch(2, retry_after='7')
+
+    assert otto.get_all_items(fetch, 50) == [0]
+    assert len(calls) == 3
+    assert blocks == [7.0, 7.0]
+
+
+def test_429_retries_give_up(otto):
+    fetch, calls = _rate_limited_fetch(float('inf'))
+
+    with pytest.raises(spotipy.SpotifyException):
+        otto.get_all_items(fetch, 50)
+    assert len(calls) == otto.MAX_RETRIES + 1
+
+
+def test_429_on_audio_features_is_retried(otto):
+    sp = FakeSpotify([30, 30])
+    audio_features = sp.audio_features
+    calls = []
+
+    def rate_limited(tracks):
+        calls.append(tracks)
+        if len(calls) == 1:
+            raise spotipy.SpotifyException(
+                429, -1, 'rate limited', headers={'Retry-After': '0'})
+        return audio_features(tracks)
+    sp.audio_features = rate_limited
+
+    results = otto.log_likelihoods_for_track(sp, {'id': 'p0-t0'}, sp.playlists)
+
+    assert len(results) == 2
+
+
+def _playlist_data(otto, sp, playlist):
+    """ The standardized continuous features of a playlist's tracks """
+    raw = np.array([[_features(item['track']['id'])[key]
+                     for key in otto.FEATURE_KEYS]
+                    for item in sp.items[playlist['id']]])
+    return otto.split_features(raw)[0].astype(np.float64)
+
+
+def test_small_playlists_get_a_diagonal_covariance(otto):
+    sp = FakeSpotify([otto.MIN_TRACKS_FULL_COV - 1])
+    data = _playlist_data(otto, sp, sp.playlists[0])
+
+    L = otto.get_distribution(sp, sp.playlists[0]).gaussian.L
+
+    np.testing.assert_array_equal(L, np.diag(np.diag(L)))
+    np.testing.assert_allclose(np.diag(L) ** 2,
+                               data.var(axis=0, ddof=1) + otto.VAR_JITTER,
+                               rtol=1e-4)
+
+
+def test_large_playlists_get_a_full_covariance(otto):
+    sp = FakeSpotify([otto.MIN_TRACKS_FULL_COV])
+    data = _playlist_data(otto, sp, sp.playlists[0])
+
+    L = otto.get_distribution(sp, sp.playlists[0]).gaussian.L
+
+    np.testing.assert_allclose(L @ L.T, np.cov(data, rowvar=False),
+                               atol=1e-4)
+
+
+def test_only_requested_playlists_are_scored(otto, monkeypatch):
+    sp = FakeSpotify([30, 30, 30, 30])
+    track = {'id': 'p0-t0'}
+    otto.log_likelihoods_for_track(sp, track, sp.playlists)
+    batch_logpdf = otto.batch_logpdf
+    scored = []
+
+    def recording_batch_logpdf(x, means, Ls, logdets):
+        scored.append(len(means))
+        return batch_logpdf(x, means, Ls, logdets)
+    monkeypatch.setattr(otto, 'batch_logpdf', recording_batch_logpdf)
+
+    results = otto.log_likelihoods_for_track(sp, track, sp.playlists[1:3])
+
+    assert scored == [2]
+    expected = {p['name']: otto.log_likelihood_track_playlist(sp, track, p)
+                for p in sp.playlists[1:3]}
+    assert dict(results) == pytest.approx(expected, rel=1e-5)
+
+
+def _record_calls(sp, name):
+    """ Record the arguments of every call to one of the client's methods """
+    method = getattr(sp, name)
+    calls = []
+
+    def recording(*args, **kwargs):
+        calls.append(args[0] if args else kwargs)
+        return method(*args, **kwargs)
+    setattr(sp, name, recording)
+    return calls
+
+
+def test_cached_audio_features_only_requests_misses(otto):
+    sp = FakeSpotify([3], no_features=['p9'])
+    requested = _record_calls(sp, 'audio_features')
+
+    first = otto.cached_audio_features(
+        sp, ['p0-t0', 'p0-t1', 'p0-t0', 'p9-t0'])
+    second = otto.cached_audio_features(sp, ['p0-t1', 'p0-t2', 'p9-t0'])
+
+    # Duplicates are requested once, and missing features aren't cached
+    assert requested == [['p0-t0', 'p0-t1', 'p9-t0'], ['p0-t2', 'p9-t0']]
+    assert [f and f['id'] for f in first] == [
+        'p0-t0', 'p0-t1', 'p0-t0', None]
+    assert second == [first[1], _features('p0-t2'), None]
+
+
+def test_cached_audio_features_requests_in_batches(otto):
+    sp = FakeSpotify([250])
+    requested = _record_calls(sp, 'audio_features')
+    ids = ['p0-t%d' % j for j in range(250)]
+
+    features = otto.cached_audio_features(sp, ids)
+
+    assert [len(batch) for batch in requested] == [100, 100, 50]
+    assert [f['id'] for f in features] == ids
+
+
+def _new_session(otto, monkeypatch):
+    """ Forget everything cached in memory, as a new session would """
+    monkeypatch.setattr(otto, '_model_store', otto.PlaylistModelStore())
+    monkeypatch.setattr(otto, '_unusable_playlists', {})
+
+
+def test_cached_distributions_are_reused_across_sessions(otto, monkeypatch):
+    sp = FakeSpotify([30])
+    fetched = _record_calls(sp, 'playlist_items')
+    model = otto.get_cached_distribution(sp, sp.playlists[0])
+    _new_session(otto, monkeypatch)
+
+    loaded = otto.get_cached_distribution(sp, sp.playlists[0])
+
+    assert len(fetched) == 1
+    np.testing.assert_array_equal(loaded.gaussian.L, model.gaussian.L)
+
+
+def test_editing_a_playlist_invalidates_its_distribution(otto, monkeypatch):
+    sp = FakeSpotify([30])
+    fetched = _record_calls(sp, 'playlist_items')
+    otto.get_cached_distribution(sp, sp.playlists[0])
+
+    sp.playlists[0]['snapshot_id'] = 'edited'
+    otto.get_cached_distribution(sp, sp.playlists[0])
+    _new_session(otto, monkeypatch)
+    otto.get_cached_distribution(sp, sp.playlists[0])
+
+    assert len(fetched) == 2
+    assert len(otto._model_store) == 1
+    with sqlite3.connect(otto.CACHE_PATH) as conn:
+        assert conn.execute('SELECT playlist_id, snapshot_id '
+                            'FROM distributions').fetchall() == [
+            ('p0', 'edited')]
+
+
+def test_model_version_invalidates_stored_distributions(otto, monkeypatch):
+    sp = FakeSpotify([30])
+    fetched = _record_calls(sp, 'playlist_items')
+    otto.get_cached_distribution(sp, sp.playlists[0])
+    _new_session(otto, monkeypatch)
+    monkeypatch.setattr(otto, 'MODEL_VERSION', otto.MODEL_VERSION + 1)
+
+    otto.get_cached_distribution(sp, sp.playlists[0])
+
+    assert len(fetched) == 2
+
+
+def test_unversioned_distribution_table_is_dropped(otto):
+    with sqlite3.connect(otto.CACHE_PATH) as conn:
+        conn.execute('CREATE TABLE distributions (playlist_id TEXT NOT NULL, '
+                     'snapshot_id TEXT NOT NULL, model BLOB NOT NULL, '
+                     'PRIMARY KEY (playlist_id, snapshot_id))')
+        conn.execute("INSERT INTO distributions VALUES ('p0', 's0', x'00')")
+    sp = FakeSpotify([30])
+
+    model = otto.get_cached_distribution(sp, sp.playlists[0])
+
+    assert np.all(np.isfinite(model.gaussian.L))
+    with sqlite3.connect(otto.CACHE_PATH) as conn:
+        assert conn.execute('SELECT playlist_id, snapshot_id, model_version '
+                            'FROM distributions').fetchall() == [
+            ('p0', 's0', otto.MODEL_VERSION)]
+
+
+def test_log_likelihoods_are_ranked_best_first(otto):
+    sp = FakeSpotify([30, 30, 30, 30, 30])
+    track = {'id': 'p3-t0'}
+
+    results = otto.log_likelihoods_for_track(sp, track, sp.playlists)
+    top = otto.log_likelihoods_for_track(sp, track, sp.playlists, top_k=2)
+
+    likelihoods = [likelihood for _, likelihood in results]
+    assert likelihoods == sorted(likelihoods, reverse=True)
+    assert top == results[:2]